@@ -14,23 +14,42 @@ RTSP Dashboard — Safe Smart PRO (Arabic UI)
 
 ملاحظة: تعتمد على نسخة "PRO" السابقة في المنطق (الكشف الذكي/الكاش/الفحص/المعاينات).
 المتطلبات:
-    pip install opencv-python pillow
+    pip install opencv-python
 (اختياري) ONVIF: pip install onvif-zeep
+(اختياري) معاينات أخف عبر FFmpeg مباشرة: pip install ffmpegcv
+(اختياري) حفظ لقطات JPEG أسرع: pip install PyTurboJPEG
+(اختياري) كشف أسرع لنوع الكاميرا من رؤوس RTSP: pip install pyahocorasick
+(اختياري) قراءة/كتابة أسرع للكاش والتفضيلات: pip install orjson
+(اختياري) حفظ لقطات PNG أسرع: pip install pyspng
 """
 import os
+import re
+import math
 import time
+import errno
 import socket
+import selectors
 import threading
+import queue
 import json
-from urllib.parse import urlparse
+import base64
+import asyncio
+import hashlib
+import secrets
+from urllib.parse import urlparse, unquote
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Optional, Dict, Tuple
+from typing import Callable, Iterable, Iterator, List, Optional, Dict, Tuple
 
-os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS", "rtsp_transport;tcp|stimeout;7000000|max_delay;5000000")
+# probesize 32KB و analyzeduration نصف ثانية بدل 5MB/5s: بث RTSP يعلن ترميزه في SDP
+# (analyzeduration;0 في libavformat يعني القيمة الافتراضية 5s لا إلغاء التحليل)
+os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS",
+                      "rtsp_transport;tcp|stimeout;7000000|max_delay;5000000"
+                      "|probesize;32768|analyzeduration;500000|fflags;nobuffer")
 os.environ.setdefault("OPENCV_LOG_LEVEL", "ERROR")
 
 try:
     import cv2
+    import numpy as np
     try:
         cv2.utils.logging.setLogLevel(cv2.utils.logging.LOG_LEVEL_ERROR)  # type: ignore
     except Exception:
@@ -46,12 +65,6 @@ except Exception:
     print("tkinter مفقود في بيئتك.")
     raise
 
-try:
-    from PIL import Image, ImageTk
-except Exception:
-    print("تحتاج لتثبيت Pillow: pip install pillow")
-    raise
-
 # ONVIF (اختياري)
 HAS_ONVIF = False
 try:
@@ -60,9 +73,57 @@ try:
 except Exception:
     HAS_ONVIF = False
 
+# ffmpegcv (اختياري) — تحجيم وتحويل الألوان داخل FFmpeg نفسه
+HAS_FFMPEGCV = False
+try:
+    import ffmpegcv  # type: ignore
+    HAS_FFMPEGCV = True
+except Exception:
+    HAS_FFMPEGCV = False
+
+# orjson (اختياري) — أسرع لحفظ/تحميل الكاش والتفضيلات
+HAS_ORJSON = False
+try:
+    import orjson  # type: ignore
+    HAS_ORJSON = True
+except Exception:
+    HAS_ORJSON = False
+
+# PyTurboJPEG (اختياري) — ترميز JPEG أسرع للّقطات
+HAS_TURBOJPEG = False
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR  # type: ignore
+    _TURBOJPEG = TurboJPEG()
+    HAS_TURBOJPEG = True
+except Exception:
+    HAS_TURBOJPEG = False
+
+# pyspng (اختياري) — ترميز PNG أسرع عبر libspng
+HAS_PYSPNG = False
+try:
+    import pyspng  # type: ignore
+    HAS_PYSPNG = True
+except Exception:
+    HAS_PYSPNG = False
+
+# Aho-Corasick (اختياري) لمطابقة رموز البائعين
+HAS_AHOCORASICK = False
+try:
+    import ahocorasick  # type: ignore
+    HAS_AHOCORASICK = True
+except Exception:
+    HAS_AHOCORASICK = False
+
 APP_TITLE = "لوحة RTSP — احترافية وآمنة (واجهة عربية)"
 CACHE_FILE = "rtsp_smart_cache.json"
 PREFS_FILE = "rtsp_prefs.json"
+PREVIEW_FPS = 10
+# بطاقات NVIDIA الاستهلاكية تحدّ عدد جلسات NVDEC المتزامنة؛ ما زاد يذهب إلى المصدر التالي
+MAX_NVDEC_SESSIONS = 3
+# اتصال اللقطة المفتوح مسبقاً يُهمل إن بقي حوار الحفظ مفتوحاً أطول من هذا (ثوانٍ)
+SNAPSHOT_PREOPEN_MAX_AGE = 5.0
+# عدد الأعمدة لكل حد معاينات شائع؛ غير ذلك: الجذر التربيعي مقرّباً لأعلى
+LAYOUT_COLS = {1: 1, 2: 2, 3: 3, 4: 2, 6: 3, 9: 3, 12: 4, 16: 4}
 
 # مقتبس من النسخة PRO (تستطيع تعديل/توسيع لاحقاً)
 VENDOR_DB: Dict[str, Dict] = {
@@ -140,6 +201,21 @@ VENDOR_DB: Dict[str, Dict] = {
     },
 }
 
+# كل رموز المطابقة في آلة واحدة تُبنى مرة عند التحميل؛ عند التعارض يفوز البائع الأسبق في VENDOR_DB
+_VENDOR_RANK = {vendor: i for i, vendor in enumerate(VENDOR_DB)}
+_TOKEN_VENDOR: Dict[str, str] = {}
+for _vendor, _info in VENDOR_DB.items():
+    for _token in _info["match"]:
+        _TOKEN_VENDOR.setdefault(_token, _vendor)
+if HAS_AHOCORASICK:
+    _VENDOR_AHO = ahocorasick.Automaton()
+    for _token, _vendor in _TOKEN_VENDOR.items():
+        _VENDOR_AHO.add_word(_token, _vendor)
+    _VENDOR_AHO.make_automaton()
+else:
+    # lookahead حتى لا تُفوّت المطابقات المتداخلة
+    _VENDOR_RE = re.compile("(?=(" + "|".join(map(re.escape, sorted(_TOKEN_VENDOR, key=len, reverse=True))) + "))")
+
 ERROR_HINTS = {
     401: "401 غير مخوّل — تحقّق من اسم المستخدم/كلمة المرور ونوع المصادقة (Basic/Digest).",
     404: "404 لم يتم العثور على البث — عدّل مسار RTSP ليتوافق مع طراز الكاميرا.",
@@ -147,6 +223,22 @@ ERROR_HINTS = {
     500: "500 — خطأ داخلي. تحقّق من الإعدادات/الإصدار وأعد المحاولة.",
 }
 
+def _json_load(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+    return orjson.loads(data) if HAS_ORJSON else json.loads(data.decode("utf-8"))
+
+def _json_dump(obj, path: str):
+    """كتابة ذرّية: ملف مؤقت ثم os.replace حتى لا يبقى ملف نصف مكتوب."""
+    if HAS_ORJSON:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        data = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
 def ping_host(ip: str, port: int, timeout: float = 1.2) -> bool:
     try:
         with socket.create_connection((ip, port), timeout=timeout):
@@ -154,48 +246,147 @@ def ping_host(ip: str, port: int, timeout: float = 1.2) -> bool:
     except OSError:
         return False
 
-def rtsp_headers(ip: str, port: int, timeout: float = 2.5) -> Dict[str, str]:
+def _parse_rtsp_response(data: bytes) -> Tuple[int, Dict[str, str]]:
+    raw = data.decode("latin1", "ignore").split("\r\n")
+    parts = raw[0].split()
+    code = int(parts[1]) if len(parts) >= 2 and parts[0].startswith("RTSP/") and parts[1].isdigit() else 0
+    headers = {}
+    for line in raw[1:]:
+        if not line.strip():
+            break
+        if ":" in line:
+            k, v = line.split(":", 1)
+            k, v = k.strip().lower(), v.strip()
+            # رؤوس مكررة (مثل WWW-Authenticate لـ Digest و Basic) تُجمع سطراً لكل قيمة
+            headers[k] = f"{headers[k]}\n{v}" if k in headers else v
+    return code, headers
+
+# رموز connect_ex التي تعني أن الاتصال غير الحاجب ما زال قيد الإنشاء
+_CONNECT_PENDING = {0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, "WSAEWOULDBLOCK", 10035)}
+
+def multi_ping(pairs: List[Tuple[str, int]], timeout: float = 1.2, batch: int = 256) -> Dict[Tuple[str, int], bool]:
+    """فحص اتصال TCP لعدة أزواج (IP, منفذ) دفعة واحدة: اتصالات غير حاجبة ثم انتظار واحد عبر selectors."""
+    result: Dict[Tuple[str, int], bool] = {}
+    unique = list(dict.fromkeys(pairs))
+    for i in range(0, len(unique), batch):
+        sel = selectors.DefaultSelector()
+        try:
+            for pair in unique[i:i+batch]:
+                result[pair] = False
+                try:
+                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                except OSError:
+                    continue
+                s.setblocking(False)
+                try:
+                    code = s.connect_ex(pair)
+                except OSError:
+                    code = -1
+                if code not in _CONNECT_PENDING:
+                    s.close()
+                    continue
+                sel.register(s, selectors.EVENT_WRITE, pair)
+            deadline = time.monotonic() + timeout
+            while sel.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _ in sel.select(remaining):
+                    sock = key.fileobj
+                    result[key.data] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                    sel.unregister(sock)
+                    sock.close()
+        finally:
+            for key in list(sel.get_map().values()):
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+            sel.close()
+    return result
+
+def rtsp_describe_or_ping(ip: str, port: int, timeout: float = 2.5) -> Tuple[bool, Dict[str, str]]:
+    """اتصال TCP واحد يجلب رؤوس DESCRIBE؛ نجاح connect نفسه هو نتيجة الـ ping."""
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.settimeout(timeout)
+    reachable = False
     headers = {}
     try:
         s.connect((ip, port))
+        reachable = True
         req = f"DESCRIBE rtsp://{ip}:{port}/ RTSP/1.0\r\nCSeq: 1\r\nUser-Agent: RTSP-ArUI/1.0\r\nAccept: application/sdp\r\n\r\n"
         s.sendall(req.encode("ascii", "ignore"))
         data = s.recv(4096)
-        raw = data.decode("latin1", "ignore").split("\r\n")
-        for line in raw[1:]:
-            if not line.strip():
-                break
-            if ":" in line:
-                k, v = line.split(":", 1)
-                headers[k.strip().lower()] = v.strip()
+        _, headers = _parse_rtsp_response(data)
     except Exception:
         pass
     finally:
         try: s.close()
         except Exception: pass
-    return headers
+    return reachable, headers
+
+def _rtsp_describe_once(host: str, port: int, uri: str, cseq: int, auth: str, timeout: float) -> Tuple[int, Dict[str, str]]:
+    req = f"DESCRIBE {uri} RTSP/1.0\r\nCSeq: {cseq}\r\nUser-Agent: RTSP-ArUI/1.0\r\nAccept: application/sdp\r\n"
+    if auth:
+        req += f"Authorization: {auth}\r\n"
+    with socket.create_connection((host, port), timeout=timeout) as s:
+        s.sendall((req + "\r\n").encode("latin1", "ignore"))
+        return _parse_rtsp_response(s.recv(4096))
+
+def _digest_auth(challenge: str, user: str, pwd: str, method: str, uri: str) -> str:
+    params = {k.lower(): (v1 or v2) for k, v1, v2 in re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', challenge)}
+    realm, nonce = params.get("realm", ""), params.get("nonce", "")
+    md5 = lambda t: hashlib.md5(t.encode("latin1", "ignore")).hexdigest()
+    ha1 = md5(f"{user}:{realm}:{pwd}")
+    ha2 = md5(f"{method}:{uri}")
+    fields = [f'username="{user}"', f'realm="{realm}"', f'nonce="{nonce}"', f'uri="{uri}"']
+    if "auth" in [q.strip() for q in params.get("qop", "").split(",")]:
+        nc, cnonce = "00000001", secrets.token_hex(8)
+        fields += [f'response="{md5(f"{ha1}:{nonce}:{nc}:{cnonce}:auth:{ha2}")}"', "qop=auth", f"nc={nc}", f'cnonce="{cnonce}"']
+    else:
+        fields.append(f'response="{md5(f"{ha1}:{nonce}:{ha2}")}"')
+    if "opaque" in params:
+        fields.append(f'opaque="{params["opaque"]}"')
+    return "Digest " + ", ".join(fields)
+
+def rtsp_describe_auth(url: str, timeout: float = 2.0) -> int:
+    """DESCRIBE خفيف بلا اعتماد أولاً، ثم رد واحد على تحدي الخادم (Digest، أو Basic فقط إن عرضه).
+    يعيد رمز الحالة، أو 0 إن لم يصل رد مفهوم."""
+    try:
+        u = urlparse(url)
+        host, port = u.hostname or "", u.port or 554
+        uri = f"rtsp://{host}:{port}{u.path}" + (f"?{u.query}" if u.query else "")
+        user = unquote(u.username) if u.username else None
+        pwd = unquote(u.password or "")
+        code, headers = _rtsp_describe_once(host, port, uri, 1, "", timeout)
+        if code != 401 or not user:
+            return code
+        challenges = headers.get("www-authenticate", "").split("\n")
+        digest = next((c for c in challenges if c.lower().startswith("digest")), None)
+        if digest:
+            auth = _digest_auth(digest, user, pwd, "DESCRIBE", uri)
+        elif any(c.lower().startswith("basic") for c in challenges):
+            auth = "Basic " + base64.b64encode(f"{user}:{pwd}".encode("utf-8")).decode("ascii")
+        else:
+            return code
+        code, _ = _rtsp_describe_once(host, port, uri, 2, auth, timeout)
+        return code
+    except Exception:
+        return 0
 
 def detect_vendor(headers: Dict[str, str]) -> str:
     text = " ".join(headers.get(k, "") for k in ("server", "www-authenticate", "proxy-authenticate")).lower()
-    for vendor, info in VENDOR_DB.items():
-        if any(token in text for token in info["match"]):
-            return vendor
-    return "generic"
-
-def build_urls(ip: str, port: int, user: Optional[str], pwd: Optional[str], paths: List[str]) -> List[str]:
-    auth = ""
-    if user:
-        if pwd is None:
-            pwd = ""
-        auth = f"{user}:{pwd}@"
-    host = f"{ip}:{port}"
-    urls = []
-    for p in paths:
-        p = str(p).lstrip("/")
-        urls.append(f"rtsp://{auth}{host}" + ("" if p == "" else f"/{p}"))
-    return urls
+    if HAS_AHOCORASICK:
+        found = {vendor for _, vendor in _VENDOR_AHO.iter(text)}
+    else:
+        found = {_TOKEN_VENDOR[m.group(1)] for m in _VENDOR_RE.finditer(text)}
+    return min(found, key=_VENDOR_RANK.__getitem__) if found else "generic"
+
+def iter_urls(ip: str, port: int, user: Optional[str], pwd: Optional[str], paths: List[str]) -> Iterator[Tuple[str, str]]:
+    """يولّد أزواج (مسار، رابط) عند الطلب فقط، فلا تُبنى روابط ما بعد أول نجاح."""
+    auth = f"{user}:{pwd or ''}@" if user else ""
+    base = f"rtsp://{auth}{ip}:{port}"
+    for pth in paths:
+        p = str(pth).lstrip("/")
+        yield pth, (base if p == "" else f"{base}/{p}")
 
 def quick_open(url: str, warm_ms: int = 220) -> bool:
     cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
@@ -207,18 +398,360 @@ def quick_open(url: str, warm_ms: int = 220) -> bool:
     cap.release()
     return bool(ok)
 
+def probe_url(url: str, warm_ms: int = 220) -> bool:
+    """DESCRIBE أولاً (ميلي ثوانٍ)؛ لا يُشغَّل FFmpeg إلا إذا أكّد الجهاز البث أو لم يُجب بوضوح.
+    إعادات التوجيه 3xx تمر أيضاً لأن FFmpeg يتبعها."""
+    code = rtsp_describe_auth(url)
+    if code not in (0, 200) and not 300 <= code < 400:
+        return False
+    return quick_open(url, warm_ms)
+
+async def quick_open_async(url: str, executor: ThreadPoolExecutor, warm_ms: int = 220) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, probe_url, url, warm_ms)
+
+async def race_open(candidates: Iterable[Tuple[str, str]], executor: ThreadPoolExecutor,
+                    concurrency: int = 2) -> Optional[Tuple[str, str]]:
+    """تجربة أزواج (مسار، رابط) بالتوازي مع الحفاظ على ترتيبها: يُعاد أول زوج ناجح حسب الترتيب
+    (البث الرئيسي قبل الفرعي)، فلا يُقبل نجاح لاحق إلا بعد فشل كل ما سبقه.
+    المرشحون يُسحبون من المكرِّر كلما فرغت خانة، فلا يُبنى ما بعد أول نجاح."""
+    it = iter(candidates)
+    pending: List[Tuple["asyncio.Future", Tuple[str, str]]] = []  # بترتيب المرشحين
+
+    def ok(t) -> bool:
+        return t.done() and t.exception() is None and bool(t.result())
+
+    def refill():
+        # لا داعي لبدء مرشحين بعد نجاح معلّق: أولويتهم أدنى منه
+        if any(ok(t) for t, _ in pending):
+            return
+        while sum(not t.done() for t, _ in pending) < concurrency:
+            cand = next(it, None)
+            if cand is None:
+                return
+            pending.append((asyncio.ensure_future(quick_open_async(cand[1], executor)), cand))
+
+    try:
+        refill()
+        while pending:
+            while pending and pending[0][0].done():
+                t, cand = pending.pop(0)
+                if ok(t):
+                    return cand
+            refill()
+            if not pending:
+                break
+            await asyncio.wait([t for t, _ in pending if not t.done()], return_when=asyncio.FIRST_COMPLETED)
+        return None
+    finally:
+        # الإلغاء يُسقط ما لم يبدأ من طابور المنفّذ المشترك؛ ما بدأ يكمل ويحرّر الـ VideoCapture بنفسه
+        for t, _ in pending:
+            t.cancel()
+
+def open_stream(url: str):
+    """VideoCapture بفك ترميز عتادي إن أتاحه بناء OpenCV (NVDEC/D3D11/VAAPI...)، وإلا على المعالج."""
+    accel = getattr(cv2, "VIDEO_ACCELERATION_ANY", None)
+    if accel is not None:
+        try:
+            # ANY: يفضّل العتاد ويعود تلقائياً إلى فك الترميز البرمجي
+            return cv2.VideoCapture(url, cv2.CAP_FFMPEG, [cv2.CAP_PROP_HW_ACCELERATION, accel])
+        except Exception:
+            pass
+    return cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+
+def grab_latest(cap, tries: int = 5, max_drain_s: float = 2.0) -> bool:
+    """grab حتى إطار حي: الإطارات المخزّنة منذ PLAY تُسحب فوراً، والحي ينتظر قرابة فترة إطار كاملة.
+    (CAP_PROP_BUFFERSIZE لا أثر له على واجهة FFmpeg.)"""
+    for _ in range(tries):
+        if cap.grab():
+            break
+    else:
+        return False
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    fps = fps if 1.0 <= fps <= 120.0 else 25.0
+    deadline = time.monotonic() + max_drain_s
+    while time.monotonic() < deadline:
+        t0 = time.monotonic()
+        if not cap.grab():
+            break
+        if time.monotonic() - t0 >= 0.5 / fps:
+            break
+    return True
+
+def save_snapshot(path: str, frame: "np.ndarray") -> bool:
+    """ترميز اللقطة في الذاكرة (يحرّر الـ GIL) ثم كتابتها مباشرة بـ os.write."""
+    ext = os.path.splitext(path)[1].lower() or ".jpg"
+    data = None
+    if HAS_TURBOJPEG and ext in (".jpg", ".jpeg"):
+        data = memoryview(_TURBOJPEG.encode(frame, quality=90, pixel_format=TJPF_BGR))
+    elif HAS_PYSPNG and ext == ".png":
+        try:
+            data = memoryview(pyspng.encode(np.ascontiguousarray(frame[:, :, ::-1]), compress_level=1))
+        except Exception:
+            data = None
+    if data is None:
+        # PNG يُختار للدقة لا للحجم: مستوى ضغط 1 أسرع بعدة مرات مع زيادة طفيفة في الحجم
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1] if ext == ".png" else [cv2.IMWRITE_JPEG_QUALITY, 90]
+        ok, buf = cv2.imencode(ext, frame, params)
+        if not ok:
+            return False
+        data = memoryview(buf).cast("B")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+    return True
+
+def prewarm_ffmpeg():
+    """تحميل مكتبات FFmpeg وتسجيل المفكّكات مرة واحدة مسبقاً: فتح مصدر فارغ يفشل فوراً بعد تحميل الواجهة."""
+    try:
+        cv2.VideoCapture("", cv2.CAP_FFMPEG).release()
+    except Exception:
+        pass
+
+def _release_capture(fut):
+    try:
+        fut.result().release()
+    except Exception:
+        pass
+
+def nvdec_available() -> bool:
+    try:
+        return hasattr(cv2, "cudacodec") and cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except Exception:
+        return False
+
+def open_nvdec_reader(url: str, target_size: Optional[Tuple[int, int]] = None):
+    """قارئ NVDEC عبر cv2.cudacodec (فك الترميز والتحجيم على GPU)، أو None إن تعذّر."""
+    try:
+        params = cv2.cudacodec.VideoReaderInitParams()
+        params.allowFrameDrop = True
+        if target_size:
+            params.targetSz = target_size
+        return cv2.cudacodec.createVideoReader(url, params=params)
+    except Exception:
+        return None
+
+def nvdec_read(reader, stream=None) -> Tuple[bool, Optional["np.ndarray"]]:
+    """قراءة الإطار التالي من قارئ NVDEC وتنزيله للذاكرة الرئيسية (BGRA)."""
+    try:
+        if stream is not None:
+            ok, gpu_frame = reader.nextFrame(stream=stream)
+            stream.waitForCompletion()
+        else:
+            ok, gpu_frame = reader.nextFrame()
+        if not ok:
+            return False, None
+        return True, gpu_frame.download()
+    except Exception:
+        return False, None
+
+def open_ffmpegcv_stream(url: str, size: Optional[Tuple[int, int]] = None, pix_fmt: str = "bgr24"):
+    """بث RTSP عبر ffmpegcv (تحجيم وتحويل الألوان داخل FFmpeg إن طُلب)، أو None إن تعذّر."""
+    if not HAS_FFMPEGCV:
+        return None
+    try:
+        kwargs = {"pix_fmt": pix_fmt}
+        if size:
+            kwargs.update(resize=size, resize_keepratio=False)
+        return ffmpegcv.VideoCaptureStream(url, **kwargs)
+    except Exception:
+        return None
+
+class _Feed:
+    def __init__(self, url: str, size: Optional[Tuple[int, int]]):
+        self.url = url
+        self.size = size
+        self.subs: List["queue.Queue"] = []
+        self.sizes: Dict["queue.Queue", Optional[Tuple[int, int]]] = {}
+        self.running = True
+        self.reopen = False
+        # هل يحترم المصدر الحالي size؟ None = لم يُفتح بعد؛ VideoCapture يتجاهله (False)
+        self.scaled: Optional[bool] = None
+
+    @property
+    def native(self) -> bool:
+        """هل تصل الإطارات فعلاً بالحجم الأصلي؟ (مطلوب أصلاً، أو المصدر لا يحجّم)"""
+        return self.size is None or self.scaled is False
+
+class CaptureBroker:
+    """مصدر واحد لكل رابط يوزّع آخر إطار (BGR/BGRA) على كل المشتركين: البلاطة والمعاينة المكبرة.
+    كل مشترك له طابور بسعة 1 يُستبدل فيه الإطار القديم، ولا يُفك ترميز إطار كامل إلا إذا فرغ طابور أحدهم."""
+
+    def __init__(self, nvdec: bool = False, cuda_stream=None, max_nvdec: int = MAX_NVDEC_SESSIONS):
+        self.nvdec = nvdec
+        self.cuda_stream = cuda_stream
+        self.max_nvdec = max_nvdec
+        self._nvdec_sessions = 0
+        self._feeds: Dict[str, _Feed] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, url: str, size: Optional[Tuple[int, int]] = None) -> Tuple["queue.Queue", Callable[[], None]]:
+        """size: حجم فك الترميز المفضّل (None = الحجم الأصلي). يُرسل None في الطابور عند انتهاء البث."""
+        q: "queue.Queue" = queue.Queue(maxsize=1)
+        with self._lock:
+            feed = self._feeds.get(url)
+            if feed is None:
+                feed = self._feeds[url] = _Feed(url, size)
+                threading.Thread(target=self._run, args=(feed,), daemon=True).start()
+            elif feed.size is not None and feed.size != size:
+                # مشترك بحجم مختلف: نعيد فتح المصدر بحجمه الأصلي ويحجّم كل مشترك لنفسه؛
+                # إلا إذا كان المصدر لا يحجّم أصلاً فإطاراته أصلية ولا داعي لمصافحة جديدة
+                feed.size = None
+                if feed.scaled is not False:
+                    feed.reopen = True
+            feed.subs.append(q)
+            feed.sizes[q] = size
+
+        def unsubscribe():
+            with self._lock:
+                if q in feed.subs:
+                    feed.subs.remove(q)
+                    del feed.sizes[q]
+                if not feed.subs:
+                    feed.running = False
+                    if self._feeds.get(url) is feed:
+                        del self._feeds[url]
+                elif feed.size is None and feed.scaled:
+                    # غادر المشترك الكبير: إن اتفق الباقون على حجم واحد نعيد فتح المصدر به
+                    # كي يعود التحجيم إلى داخل المفكّك (GPU/FFmpeg) ولا يُنقل إلا الإطار الصغير
+                    remaining = set(feed.sizes.values())
+                    if len(remaining) == 1 and None not in remaining:
+                        feed.size = remaining.pop()
+                        feed.reopen = True
+        return q, unsubscribe
+
+    def has_native_feed(self, url: str) -> bool:
+        with self._lock:
+            feed = self._feeds.get(url)
+            return feed is not None and feed.native and feed.running
+
+    def snapshot(self, url: str, timeout: float = 3.0) -> Optional["np.ndarray"]:
+        """إطار بالحجم الأصلي من مصدر مشترك قائم (بلا مصافحة RTSP جديدة)، أو None إن لم يوجد.
+        المصدر الذي يحجّم إلى حجم البلاطة لا يصلح للقطة، ولا نعيد فتحه كي لا تنقطع المعاينة."""
+        with self._lock:
+            feed = self._feeds.get(url)
+            if feed is None or not feed.native or not feed.running:
+                return None
+        frames, unsubscribe = self.subscribe(url)
+        try:
+            return frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        finally:
+            unsubscribe()
+
+    @staticmethod
+    def _offer(q: "queue.Queue", item):
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            try: q.get_nowait()
+            except queue.Empty: pass
+            try: q.put_nowait(item)
+            except queue.Full: pass
+
+    def _sources(self, feed: _Feed):
+        """المصادر بالترتيب: NVDEC ثم ffmpegcv ثم VideoCapture؛ كلٌّ يُفتح فقط إذا لم يُخرج سابقه أي إطار.
+        read(want) تعيد (ok, frame) وقد يكون frame = None إن لم يُطلب إطار."""
+        if self.nvdec and self._acquire_nvdec():
+            feed.scaled = True
+            reader = open_nvdec_reader(feed.url, feed.size)
+            if reader is not None:
+                # القارئ في حاوية تُفرغ عند التحرير: لو بقي مربوطاً في إطار المولّد لظلت جلسة NVDEC
+                # واتصال RTSP محجوزين طوال عمل المصدر البديل
+                holder = [reader]
+                del reader
+                def release_nvdec():
+                    holder.clear()
+                    self._release_nvdec()
+                yield (lambda want: nvdec_read(holder[0], self.cuda_stream)), release_nvdec
+            else:
+                self._release_nvdec()
+        feed.scaled = True
+        fcap = open_ffmpegcv_stream(feed.url, feed.size)
+        if fcap is not None:
+            yield (lambda want: fcap.read()), fcap.release
+        feed.scaled = False
+        cap = open_stream(feed.url)
+        if not cap.isOpened():
+            cap.release()
+            return
+        # grab دائماً، وretrieve (التحويل إلى BGR) فقط عند الطلب؛ الإسقاط إلى الأحدث تتكفل به
+        # طوابير المشتركين بسعة 1 (CAP_PROP_BUFFERSIZE لا أثر له على واجهة FFmpeg)
+        def read(want):
+            if not cap.grab():
+                return False, None
+            return cap.retrieve() if want else (True, None)
+        yield read, cap.release
+
+    def _acquire_nvdec(self) -> bool:
+        with self._lock:
+            if self._nvdec_sessions >= self.max_nvdec:
+                return False
+            self._nvdec_sessions += 1
+            return True
+
+    def _release_nvdec(self):
+        with self._lock:
+            self._nvdec_sessions -= 1
+
+    def _pump(self, feed: _Feed, read) -> bool:
+        delivered = False
+        consecutive_fail = 0
+        while feed.running and not feed.reopen:
+            with self._lock:
+                subs = list(feed.subs)
+            ok, frame = read(any(q.empty() for q in subs))
+            if not ok:
+                consecutive_fail += 1
+                if consecutive_fail >= 10:
+                    break
+                continue
+            consecutive_fail = 0
+            if frame is None:
+                continue
+            delivered = True
+            for q in subs:
+                self._offer(q, frame)
+        return delivered
+
+    def _run(self, feed: _Feed):
+        while feed.running:
+            feed.reopen = False
+            for read, release in self._sources(feed):
+                try:
+                    delivered = self._pump(feed, read)
+                finally:
+                    try: release()
+                    except Exception: pass
+                if delivered or not feed.running or feed.reopen:
+                    break
+            if not feed.reopen:
+                break
+        with self._lock:
+            if self._feeds.get(feed.url) is feed:
+                del self._feeds[feed.url]
+            subs = list(feed.subs)
+        for q in subs:
+            self._offer(q, None)
+
 # -------------------------------- UI ---------------------------------
 
 class BigPreview(tk.Toplevel):
-    def __init__(self, master, title: str, url: str):
+    def __init__(self, master, title: str, url: str, broker: CaptureBroker):
         super().__init__(master)
         self.title(title)
         self.geometry("960x540")
         self.label = ttk.Label(self, text="...")
         self.label.pack(fill="both", expand=True)
         self.running = True
-        self.cap = None
         self.url = url
+        self.broker = broker
+        self._ppm_size: Tuple[int, int] = (0, 0)
+        self._ppm_header = b""
         self.after(10, self._start)
 
     def _start(self):
@@ -226,47 +759,102 @@ class BigPreview(tk.Toplevel):
 
     def destroy(self):
         self.running = False
-        try:
-            if self.cap is not None:
-                self.cap.release()
-        except Exception:
-            pass
         super().destroy()
 
     def _loop(self):
-        cap = cv2.VideoCapture(self.url, cv2.CAP_FFMPEG)
-        if not cap.isOpened():
-            self.after(0, lambda: self.label.config(text="تعذر فتح البث"))
-            return
-        self.cap = cap
-        while self.running:
-            ok, frame = cap.read()
-            if not ok:
-                continue
-            # ملاءمة نافذة المعاينة
-            try:
-                w = max(self.label.winfo_width(), 640)
-                h = max(self.label.winfo_height(), 360)
-                frame = cv2.resize(frame, (w, h))
-                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            except Exception:
+        frames, unsubscribe = self.broker.subscribe(self.url)
+        try:
+            while self.running:
+                try:
+                    frame = frames.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if frame is None:
+                    self.after(0, lambda: self.label.config(text="تعذر فتح البث"))
+                    return
+                # ملاءمة نافذة المعاينة
+                try:
+                    w = max(self.label.winfo_width(), 640)
+                    h = max(self.label.winfo_height(), 360)
+                    small = cv2.resize(frame, (w, h), interpolation=cv2.INTER_LINEAR)
+                    # تبديل القنوات BGR(A)→RGB بالتقطيع بدل cvtColor (نسخة واحدة فقط)
+                    rgb = np.ascontiguousarray(small[:, :, 2::-1])
+                except Exception:
+                    continue
+                if self._ppm_size != (w, h):
+                    self._ppm_size = (w, h)
+                    self._ppm_header = f"P6\n{w} {h}\n255\n".encode("ascii")
+                def update_on_main(data=self._ppm_header + rgb.tobytes()):
+                    imgtk = tk.PhotoImage(master=self.label, data=data)
+                    self.label.imgtk = imgtk
+                    self.label.config(image=imgtk, text="")
+                self.after(0, update_on_main)
+        finally:
+            unsubscribe()
+
+class PreviewDispatcher:
+    """خيط واحد يخدم كل بلاطات المعاينة: يسحب آخر إطار من طابور كل بلاطة حين يحين موعدها ويرسمه،
+    بدل خيط مستهلك محجوز لكل بلاطة. (فك الترميز نفسه يبقى في خيوط CaptureBroker لأن VideoCapture حاجب.)"""
+
+    def __init__(self):
+        self._tiles: List["PreviewTile"] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, tile: "PreviewTile"):
+        with self._lock:
+            if tile not in self._tiles:
+                self._tiles.append(tile)
+        self._wake.set()
+
+    def remove(self, tile: "PreviewTile"):
+        with self._lock:
+            if tile in self._tiles:
+                self._tiles.remove(tile)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                tiles = list(self._tiles)
+            if not tiles:
+                self._wake.wait()
+                self._wake.clear()
                 continue
-            def update_on_main(img_arr=rgb):
-                pil_img = Image.fromarray(img_arr)
-                imgtk = ImageTk.PhotoImage(master=self.label, image=pil_img)
-                self.label.imgtk = imgtk
-                self.label.config(image=imgtk, text="")
-            self.after(0, update_on_main)
+            now = time.monotonic()
+            next_due = now + 0.05
+            for tile in tiles:
+                if now >= tile.next_due:
+                    try:
+                        tile.service(now)
+                    except Exception:
+                        pass
+                next_due = min(next_due, tile.next_due)
+            time.sleep(max(0.005, next_due - time.monotonic()))
 
 class PreviewTile(ttk.Frame):
-    def __init__(self, master, cam_id: int, url: str, on_close, on_open_big, *args, **kwargs):
+    def __init__(self, master, cam_id: int, url: str, on_close, on_open_big, *args, broker: CaptureBroker,
+                 dispatcher: PreviewDispatcher, fps: float = PREVIEW_FPS, **kwargs):
         super().__init__(master, padding=6, *args, **kwargs)
         self.cam_id = cam_id
         self.url = url
+        self.broker = broker
+        self.dispatcher = dispatcher
+        self.interval = 1.0 / max(fps, 1.0)
+        self.next_due = 0.0
         self.on_close = on_close
         self.on_open_big = on_open_big
         self.running = False
-        self.cap = None
+        self._closing = False
+        self._frames: Optional["queue.Queue"] = None
+        self._unsubscribe: Optional[Callable[[], None]] = None
+        self._outstanding = 0
+        # مخازن ثابتة تُعاد لكل إطار: ملف PPM كامل (الرأس + البكسلات) يُكتب فيه RGB مباشرة
+        header = b"P6\n320 240\n255\n"
+        self._ppm = bytearray(header) + bytearray(240 * 320 * 3)
+        self._ppm_rgb = np.frombuffer(self._ppm, dtype=np.uint8, offset=len(header)).reshape(240, 320, 3)
+        self._resize_buf = np.empty((240, 320, 3), dtype=np.uint8)
+        self._photo: Optional[tk.PhotoImage] = None
         self._build()
 
     def _build(self):
@@ -283,49 +871,61 @@ class PreviewTile(ttk.Frame):
     def start(self):
         if self.running: return
         self.running = True
-        threading.Thread(target=self._loop, daemon=True).start()
+        self._frames, self._unsubscribe = self.broker.subscribe(self.url, (320, 240))
+        self.next_due = 0.0
+        self.dispatcher.add(self)
 
     def stop(self):
+        # آمنة للاستدعاء أكثر من مرة (زر الإيقاف، انتهاء البث، إغلاق اللوحة)
+        if self._closing: return
+        self._closing = True
         self.running = False
+        self._detach()
         self.after(0, self._cleanup)
 
+    def _detach(self):
+        self.dispatcher.remove(self)
+        unsubscribe, self._unsubscribe = self._unsubscribe, None
+        if unsubscribe is not None:
+            unsubscribe()
+
     def _cleanup(self):
-        if self.cap is not None:
-            try: self.cap.release()
-            except Exception: pass
-            self.cap = None
         self.on_close(self.cam_id)
 
-    def _loop(self):
-        cap = cv2.VideoCapture(self.url, cv2.CAP_FFMPEG)
-        if not cap.isOpened():
+    def _post_frame(self, data: bytes):
+        def update_on_main():
+            self._outstanding -= 1
+            # صورة Tk واحدة تُحدَّث في مكانها بدل إنشاء PhotoImage لكل إطار
+            if self._photo is None:
+                self._photo = tk.PhotoImage(master=self.label, data=data)
+                self.label.config(image=self._photo, text="")
+            else:
+                self._photo.configure(data=data)
+        self._outstanding += 1
+        self.after(0, update_on_main)
+
+    def service(self, now: float):
+        """يُستدعى من PreviewDispatcher عند حلول موعد البلاطة."""
+        # لا نسحب إطاراً إذا تراكمت تحديثات لم يرسمها Tk بعد؛ يبقى أحدث إطار في الطابور
+        if not self.running or self._outstanding > 1:
+            self.next_due = now + 0.01
+            return
+        try:
+            frame = self._frames.get_nowait()
+        except queue.Empty:
+            self.next_due = now + 0.01
+            return
+        if frame is None:
             self.after(0, lambda: self.label.config(text="تعذر فتح البث"))
-            self.running = False
-            self.after(0, self._cleanup)
+            self.stop()
             return
-        self.cap = cap
-        consecutive_fail = 0
-        while self.running:
-            ok, frame = cap.read()
-            if not ok:
-                consecutive_fail += 1
-                if consecutive_fail >= 10:
-                    break
-                continue
-            consecutive_fail = 0
-            try:
-                frame = cv2.resize(frame, (320, 240))
-                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            except Exception:
-                continue
-            def update_on_main(img_arr=rgb):
-                pil_img = Image.fromarray(img_arr)
-                imgtk = ImageTk.PhotoImage(master=self.label, image=pil_img)
-                self.label.imgtk = imgtk
-                self.label.config(image=imgtk, text="")
-            self.after(0, update_on_main)
-        self.running = False
-        self.after(0, self._cleanup)
+        self.next_due = now + self.interval
+        bgra = frame.shape[2] == 4
+        small = frame
+        if frame.shape[:2] != (240, 320):
+            small = cv2.resize(frame, (320, 240), dst=None if bgra else self._resize_buf, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(small, cv2.COLOR_BGRA2RGB if bgra else cv2.COLOR_BGR2RGB, dst=self._ppm_rgb)
+        self._post_frame(bytes(self._ppm))
 
 class Dashboard(tk.Tk):
     def __init__(self):
@@ -334,6 +934,9 @@ class Dashboard(tk.Tk):
         self.geometry("1360x900")
         self.minsize(1150, 780)
         self.big_previews: Dict[int, BigPreview] = {}
+        # فك ترميز المعاينات على NVDEC عند توفر GPU من NVIDIA، مع تيار CUDA مشترك
+        self.use_nvdec = nvdec_available()
+        self.cuda_stream = cv2.cuda.Stream() if self.use_nvdec else None
 
         style = ttk.Style()
         try: style.theme_use("clam")
@@ -347,46 +950,78 @@ class Dashboard(tk.Tk):
         style.configure("URL.TLabel", foreground="#1558d6")
 
         self.rows: Dict[int, Dict] = {}
+        self._visible_iids: List[str] = []
+        self._row_values: Dict[str, Tuple] = {}
+        self._filter_pending: Optional[str] = None
+        self._refresh_pending = False
         self.preview_tiles: Dict[int, PreviewTile] = {}
         self.max_workers = 8
+        self._probe_pool: Optional[ThreadPoolExecutor] = None
+        self._probe_pool_size = 0
+        self._race_pool: Optional[ThreadPoolExecutor] = None
+        self._race_pool_size = 0
+        self._race_pool_lock = threading.Lock()
+        self._snapshot_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="snapshot")
         self.max_previews = 6
         self.cache: Dict[str, Dict] = {}
+        self._cache_lock = threading.Lock()
+        self._cache_dirty = threading.Event()
         self._load_cache()
         self._load_prefs()
+        self.broker = CaptureBroker(nvdec=self.use_nvdec, cuda_stream=self.cuda_stream,
+                                    max_nvdec=int(self.prefs.get("max_nvdec_sessions", MAX_NVDEC_SESSIONS)))
+        self.dispatcher = PreviewDispatcher()
 
         self._build_ui()
+        # كاتب كاش مؤجَّل: التعديلات المتتالية تُجمع في كتابة واحدة
+        threading.Thread(target=self._cache_writer_loop, daemon=True).start()
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+        threading.Thread(target=prewarm_ffmpeg, daemon=True).start()
 
     # --------------- PREFERENCES -----------------
     def _load_prefs(self):
-        self.prefs = {"probe_threads": 8, "max_previews": 6, "port": 554}
+        self.prefs = {"probe_threads": 8, "max_previews": 6, "port": 554, "neg_ttl": 600, "preview_fps": PREVIEW_FPS,
+                      "max_nvdec_sessions": MAX_NVDEC_SESSIONS, "race_concurrency": 2}
         try:
-            with open(PREFS_FILE, "r", encoding="utf-8") as f:
-                self.prefs.update(json.load(f))
+            self.prefs.update(_json_load(PREFS_FILE))
         except Exception:
             pass
 
     def _save_prefs(self):
         try:
-            with open(PREFS_FILE, "w", encoding="utf-8") as f:
-                json.dump(self.prefs, f, ensure_ascii=False, indent=2)
+            _json_dump(self.prefs, PREFS_FILE)
         except Exception:
             pass
 
     # --------------- CACHE -----------------
     def _load_cache(self):
         try:
-            with open(CACHE_FILE, "r", encoding="utf-8") as f:
-                self.cache = json.load(f)
+            self.cache = _json_load(CACHE_FILE)
         except Exception:
             self.cache = {}
 
     def _save_cache(self):
         try:
-            with open(CACHE_FILE, "w", encoding="utf-8") as f:
-                json.dump(self.cache, f, ensure_ascii=False, indent=2)
+            with self._cache_lock:
+                _json_dump(self.cache, CACHE_FILE)
         except Exception:
             pass
 
+    def _cache_writer_loop(self):
+        while True:
+            self._cache_dirty.wait()
+            time.sleep(0.5)
+            self._cache_dirty.clear()
+            self._save_cache()
+
+    def _on_close(self):
+        # هنا لا في atexit: خطّاف concurrent.futures ينتظر خيوط الأحواض ويفرّغ طوابيرها قبل أي معالج atexit
+        self._shutdown_probe_pool()
+        self._snapshot_pool.shutdown(wait=False, cancel_futures=True)
+        # حفظ دون شرط: الكاتب يمسح العلَم قبل الكتابة، و_save_cache ينتظر كتابته الجارية عبر القفل
+        self._save_cache()
+        self.destroy()
+
     # --------------- UI -----------------
     def _build_ui(self):
         # شريط أدوات علوي
@@ -431,7 +1066,7 @@ class Dashboard(tk.Tk):
         ttk.Label(search_bar, text="تصفية:").pack(side="left")
         self.filter_entry = ttk.Entry(search_bar, width=40)
         self.filter_entry.pack(side="left", padx=6)
-        self.filter_entry.bind("<KeyRelease>", lambda e: self._refresh_table())
+        self.filter_entry.bind("<KeyRelease>", self._debounce_filter)
 
         # الجدول
         table_box = ttk.LabelFrame(left, text="الكاميرات", padding=6)
@@ -497,6 +1132,10 @@ class Dashboard(tk.Tk):
         preview_box.pack(fill="both", expand=True)
         self.preview_grid = ttk.Frame(preview_box)
         self.preview_grid.pack(fill="both", expand=True)
+        self._layout_cols = 0
+        self._plan: List[Tuple[int, int]] = []
+        self._rebuild_layout_plan()
+        self.previews_var.trace_add("write", self._rebuild_layout_plan)
 
         self.status_label = ttk.Label(self, text="جاهز", style="Status.TLabel")
         self.status_label.pack(anchor="w", padx=12, pady=(0,10))
@@ -534,21 +1173,44 @@ class Dashboard(tk.Tk):
             self._set_status("لا يوجد ما يُنسخ.", "warn")
 
     def _sort_by(self, col, descending):
-        data = [(self.tree.set(child, col), child) for child in self.tree.get_children('')]
-        try:
-            data.sort(reverse=descending, key=lambda t: (float(t[0].split()[0]) if col=="latency" and t[0]!="n/a" else t[0]))
-        except Exception:
-            data.sort(reverse=descending, key=lambda t: t[0])
+        # مفاتيح مُعدّة مسبقاً حسب نوع العمود: أرقام للمعرّف والكمون بدل تحليل النص لكل مقارنة
+        if col == "latency":
+            data = [(self.rows[int(child)].get("_latency_ms", float("inf")), child) for child in self.tree.get_children('')]
+        elif col == "id":
+            data = [(int(child), child) for child in self.tree.get_children('')]
+        else:
+            data = [(self.tree.set(child, col), child) for child in self.tree.get_children('')]
+        data.sort(reverse=descending, key=lambda t: t[0])
         for ix, item in enumerate(data):
             self.tree.move(item[1], '', ix)
+        self._visible_iids = [item[1] for item in data]
         self.tree.heading(col, command=lambda: self._sort_by(col, not descending))
 
     # ----------------- Data/Table -----------------
+    def _debounce_filter(self, event=None):
+        # إعادة التصفية بعد توقف الكتابة 150ms بدل كل ضغطة مفتاح
+        if self._filter_pending is not None:
+            self.after_cancel(self._filter_pending)
+        self._filter_pending = self.after(150, self._on_filter_idle)
+
+    def _on_filter_idle(self):
+        self._filter_pending = None
+        self._refresh_table()
+
+    def _schedule_refresh(self):
+        # تجميع نتائج الفحص المتتالية في إعادة رسم واحدة كل 200ms على الأكثر
+        if self._refresh_pending:
+            return
+        self._refresh_pending = True
+        self.after(200, self._do_refresh)
+
+    def _do_refresh(self):
+        self._refresh_pending = False
+        self._refresh_table()
+
     def _refresh_table(self):
         # collect text filter
         text_filter = (self.filter_entry.get() or "").strip().lower()
-        for item in self.tree.get_children():
-            self.tree.delete(item)
         f = self.filter_var.get()
         rows = list(self.rows.values())
         if f == "SUCCESS":
@@ -560,9 +1222,27 @@ class Dashboard(tk.Tk):
                 bundle = f"{r['ip']} {r.get('vendor','')} {r.get('path','')} {r.get('status','')} {r.get('url','')}".lower()
                 return text_filter in bundle
             rows = [r for r in rows if match(r)]
-        for r in rows:
+        # ترقيع الجدول بدل حذف كل الصفوف وإعادة إدراجها: فصل ما لم يعد مطابقاً، تحديث ما تغيّر فقط
+        desired = [str(r["id"]) for r in rows]
+        desired_set = set(desired)
+        for iid in self._visible_iids:
+            if iid not in desired_set:
+                self.tree.detach(iid)
+        kept = [iid for iid in self._visible_iids if iid in desired_set]
+        reorder = kept != desired[:len(kept)]
+        for idx, (iid, r) in enumerate(zip(desired, rows)):
+            values = (r["id"], r["ip"], r.get("vendor",""), r.get("path",""), r.get("status",""), r.get("latency",""), r.get("url",""))
             tags = (r.get("status",""),)
-            self.tree.insert("", "end", iid=str(r["id"]), values=(r["id"], r["ip"], r.get("vendor",""), r.get("path",""), r.get("status",""), r.get("latency",""), r.get("url","")), tags=tags)
+            if not self.tree.exists(iid):
+                self.tree.insert("", idx, iid=iid, values=values, tags=tags)
+                self._row_values[iid] = values
+                continue
+            if self._row_values.get(iid) != values:
+                self.tree.item(iid, values=values, tags=tags)
+                self._row_values[iid] = values
+            if reorder or idx >= len(kept):
+                self.tree.move(iid, "", idx)
+        self._visible_iids = desired
 
     def _set_status(self, text, kind="info"):
         style = {"good":"Good.TLabel", "warn":"Warn.TLabel", "bad":"Bad.TLabel"}.get(kind, "Status.TLabel")
@@ -610,18 +1290,28 @@ class Dashboard(tk.Tk):
         if path is None: return
         path = path.strip() or "__AUTO__"
         for cam_id in sel:
-            r = self.rows[cam_id]; r["path"] = path; r["status"] = "NEW"; r["url"] = ""; r["latency"]=""
+            r = self.rows[cam_id]; r["path"] = path; r["status"] = "NEW"; r["url"] = ""; r["latency"]=""; r.pop("_latency_ms", None)
         self._refresh_table()
 
     # --- ذكاء الفحص (مبسّط: يعتمد على رؤوس RTSP والكاش) ---
-    def _smart_probe_single(self, r: Dict) -> Tuple[str, str, str, float, str, Tuple[Optional[str], Optional[str], int]]:
+    def _neg_cached(self, r: Dict) -> bool:
+        """كاميرا فشلت مؤخراً (ضمن neg_ttl) ومسارها تلقائي: لا داعي لإعادة المسح الكامل."""
+        if r.get("path", "__AUTO__") != "__AUTO__":
+            return False
+        return self.cache.get(r["ip"], {}).get("neg", {}).get("until", 0) > time.time()
+
+    def _smart_probe_single(self, r: Dict, reach: Optional[Dict[Tuple[str, int], bool]] = None,
+                            use_neg: bool = True) -> Tuple[str, str, str, float, str, Tuple[Optional[str], Optional[str], int]]:
         ip = r["ip"]
         user, pwd = r.get("user"), r.get("pwd")
         path_setting = r.get("path", "__AUTO__")
         # منافذ مرشحة
         base_port = int(r.get("port") or 554)
+        if use_neg and self._neg_cached(r):
+            # زمن سالب: يظهر "n/a" ويُرتَّب في الآخر بدل أن يبدو أسرع كاميرا
+            return "FAILED", "", r.get("vendor", "unknown"), -1.0, "", (user, pwd, base_port)
         candidate_ports: List[int] = [base_port]
-        headers = self._rtsp_headers_safe(ip, base_port)
+        base_reachable, headers = self._rtsp_describe_safe(ip, base_port)
         vendor = detect_vendor(headers)
         vendor_info = VENDOR_DB.get(vendor, VENDOR_DB["generic"])
         for p in vendor_info.get("ports", []):
@@ -630,54 +1320,77 @@ class Dashboard(tk.Tk):
             if p not in candidate_ports: candidate_ports.append(p)
         # مسارات
         paths = [path_setting] if path_setting != "__AUTO__" else (vendor_info["paths"] or VENDOR_DB["generic"]["paths"])
+        # كثير من الكاميرات لا تقبل أكثر من جلستين متزامنتين
+        concurrency = max(1, int(self.prefs.get("race_concurrency", 2)))
+        executor = self._get_race_pool(concurrency)
         start = time.time()
         for port in candidate_ports:
-            if not ping_host(ip, port):
+            if port == base_port:
+                reachable = base_reachable
+            else:
+                reachable = reach.get((ip, port)) if reach is not None else None
+            if reachable is None:
+                reachable = ping_host(ip, port)
+            if not reachable:
                 continue
-            urls = build_urls(ip, port, user, pwd, paths)
-            for pth, url in zip(paths, urls):
-                if quick_open(url):
-                    elapsed_ms = (time.time()-start)*1000.0
-                    return "SUCCESS", url, vendor, elapsed_ms, pth, (user, pwd, port)
+            hit = asyncio.run(race_open(iter_urls(ip, port, user, pwd, paths), executor, concurrency))
+            if hit:
+                pth, url = hit
+                elapsed_ms = (time.time()-start)*1000.0
+                return "SUCCESS", url, vendor, elapsed_ms, pth, (user, pwd, port)
             if self.try_defaults_var.get():
                 defaults = vendor_info.get("defaults", [])[:3]
                 for u, pw in defaults:
-                    urls = build_urls(ip, port, u, pw, paths)
-                    for pth, url in zip(paths, urls):
-                        if quick_open(url):
-                            elapsed_ms = (time.time()-start)*1000.0
-                            return "SUCCESS", url, vendor, elapsed_ms, pth, (u, pw, port)
+                    hit = asyncio.run(race_open(iter_urls(ip, port, u, pw, paths), executor, concurrency))
+                    if hit:
+                        pth, url = hit
+                        elapsed_ms = (time.time()-start)*1000.0
+                        return "SUCCESS", url, vendor, elapsed_ms, pth, (u, pw, port)
         elapsed_ms = (time.time()-start)*1000.0
         return "FAILED","", vendor, elapsed_ms, (paths[0] if paths else ""), (user, pwd, base_port)
 
-    def _rtsp_headers_safe(self, ip, port):
+    def _rtsp_describe_safe(self, ip, port):
         try:
-            return rtsp_headers(ip, port)
+            return rtsp_describe_or_ping(ip, port)
         except Exception:
-            return {}
+            return False, {}
 
     def on_probe_all(self): self._probe_ids(list(self.rows.keys()))
     def on_probe_selected(self):
         sel = [int(i) for i in self.tree.selection()]
         if not sel: messagebox.showinfo("معلومة", "اختر كاميرات من الجدول أولاً."); return
-        self._probe_ids(sel)
+        # فحص صريح لكاميرات بعينها (غالباً بعد تصحيح الاعتماد): يتجاوز كاش الفشل
+        self._probe_ids(sel, use_neg=False)
 
-    def _probe_ids(self, ids: List[int]):
+    def _probe_ids(self, ids: List[int], use_neg: bool = True):
         if not ids: return
         self._set_status("جاري الفحص الذكي...", "warn")
         self.max_workers = int(self.threads_var.get() or 8)
+        pool = self._get_probe_pool()
 
         def run():
             succ, fail = 0, 0
-            with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
-                futures = {ex.submit(self._smart_probe_single, self.rows[cid]): cid for cid in ids}
-                for fut in as_completed(futures):
-                    cam_id = futures[fut]
-                    status, url, vendor, elapsed, path_used, creds = fut.result()
-                    r = self.rows[cam_id]
-                    r["status"] = status; r["url"]=url; r["latency"]=f"{elapsed:.0f} ms" if elapsed>=0 else "n/a"
-                    r["vendor"] = vendor
-                    if path_used: r["path"] = path_used
+            # فحص كل المنافذ المرشحة لكل الكاميرات دفعة واحدة بدل اتصال حاجب لكل زوج
+            # (المنفذ الأساسي يُفحص ضمن طلب DESCRIBE نفسه)
+            all_ports = sorted({p for info in VENDOR_DB.values() for p in info["ports"]})
+            pairs = []
+            for cid in ids:
+                r = self.rows[cid]
+                if use_neg and self._neg_cached(r):
+                    continue
+                base_port = int(r.get("port") or 554)
+                pairs.extend((r["ip"], p) for p in all_ports if p != base_port)
+            reach = multi_ping(pairs)
+            futures = {pool.submit(self._smart_probe_single, self.rows[cid], reach, use_neg): cid for cid in ids}
+            for fut in as_completed(futures):
+                cam_id = futures[fut]
+                status, url, vendor, elapsed, path_used, creds = fut.result()
+                r = self.rows[cam_id]
+                r["status"] = status; r["url"]=url; r["latency"]=f"{elapsed:.0f} ms" if elapsed>=0 else "n/a"
+                r["_latency_ms"] = elapsed if elapsed >= 0 else float("inf")
+                r["vendor"] = vendor
+                if path_used: r["path"] = path_used
+                with self._cache_lock:
                     if status == "SUCCESS":
                         succ += 1
                         u,pw,port_used = creds
@@ -685,11 +1398,44 @@ class Dashboard(tk.Tk):
                         self.cache[r["ip"]] = {"vendor": vendor, "path": r["path"], "user": u, "pwd": pw, "port": port_used}
                     else:
                         fail += 1
-                    self.after(0, self._refresh_table)
-            self._save_cache()
+                        entry = self.cache.setdefault(r["ip"], {})
+                        if entry.get("neg", {}).get("until", 0) <= time.time():
+                            entry["neg"] = {"until": time.time() + float(self.prefs.get("neg_ttl", 600))}
+                self._cache_dirty.set()
+                self.after(0, self._schedule_refresh)
+            self.after(0, self._refresh_table)
             self.after(0, lambda: self._set_status(f"انتهى الفحص — ناجحة: {succ}, فاشلة: {fail}", "good" if succ else "bad"))
         threading.Thread(target=run, daemon=True).start()
 
+    def _get_probe_pool(self) -> ThreadPoolExecutor:
+        # خيوط فحص دافئة تُعاد بين الدفعات؛ تُنشأ من جديد فقط إذا تغيّر عددها
+        if self._probe_pool is None or self._probe_pool_size != self.max_workers:
+            if self._probe_pool is not None:
+                self._probe_pool.shutdown(wait=False)
+            self._probe_pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="probe")
+            self._probe_pool_size = self.max_workers
+        return self._probe_pool
+
+    def _get_race_pool(self, concurrency: int) -> ThreadPoolExecutor:
+        # منفّذ واحد لكل سباقات فتح الروابط (خيط الفحص × التوازي)، بدل منفّذ جديد لكل سباق
+        size = self.max_workers * concurrency
+        with self._race_pool_lock:
+            if self._race_pool is None or self._race_pool_size != size:
+                if self._race_pool is not None:
+                    self._race_pool.shutdown(wait=False)
+                self._race_pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix="race")
+                self._race_pool_size = size
+            return self._race_pool
+
+    def _shutdown_probe_pool(self):
+        if self._probe_pool is not None:
+            self._probe_pool.shutdown(wait=False, cancel_futures=True)
+            self._probe_pool = None
+        with self._race_pool_lock:
+            if self._race_pool is not None:
+                self._race_pool.shutdown(wait=False, cancel_futures=True)
+                self._race_pool = None
+
     def on_start_selected(self):
         ids = [int(i) for i in self.tree.selection()]
         if not ids: messagebox.showinfo("معلومة", "اختر كاميرات ناجحة من الجدول."); return
@@ -698,34 +1444,69 @@ class Dashboard(tk.Tk):
         self.max_previews = int(self.previews_var.get() or 6)
         current = len(self.preview_tiles); slots = max(0, self.max_previews - current)
         if slots <= 0: messagebox.showwarning("تنبيه", "وصلت للحد الأقصى للمعاينات."); return
-        for cam_id in success_ids[:slots]:
-            self._open_preview(cam_id)
+        # تجميد حجم الشبكة أثناء الإضافة ثم إعادة تخطيط واحدة بدل N
+        self.preview_grid.grid_propagate(False)
+        try:
+            for cam_id in success_ids[:slots]:
+                self._open_preview(cam_id)
+        finally:
+            self.preview_grid.grid_propagate(True)
+            self.update_idletasks()
 
     def _open_preview(self, cam_id: int):
         if cam_id in self.preview_tiles: return
         url = self.rows[cam_id]["url"]
-        tile = PreviewTile(self.preview_grid, cam_id, url, on_close=self._on_tile_close, on_open_big=self._open_big_preview)
+        tile = PreviewTile(self.preview_grid, cam_id, url, on_close=self._on_tile_close, on_open_big=self._open_big_preview,
+                           broker=self.broker, dispatcher=self.dispatcher, fps=float(self.prefs.get("preview_fps", PREVIEW_FPS)))
         self.preview_tiles[cam_id] = tile
-        idx = len(self.preview_tiles)-1; r, c = divmod(idx, 3)
+        idx = len(self.preview_tiles)-1
+        r, c = self._plan[idx] if idx < len(self._plan) else divmod(idx, self._layout_cols)
         tile.grid(row=r, column=c, padx=6, pady=6, sticky="nsew")
-        self.preview_grid.grid_columnconfigure(c, weight=1)
         tile.start(); self._set_status(f"تشغيل معاينة للكاميرا #{cam_id}", "good")
 
+    def _rebuild_layout_plan(self, *_):
+        # خطة مواقع (صف، عمود) محسوبة مرة لكل قيمة من "عدد المعاينات"
+        try:
+            n = max(1, int(self.previews_var.get()))
+        except (tk.TclError, ValueError):
+            return
+        cols = LAYOUT_COLS.get(n, math.ceil(math.sqrt(n)))
+        if cols != self._layout_cols:
+            for c in range(max(cols, self._layout_cols)):
+                self.preview_grid.grid_columnconfigure(c, weight=1 if c < cols else 0)
+            self._layout_cols = cols
+            self._plan = [divmod(i, cols) for i in range(n)]
+            self._relayout_tiles()
+        else:
+            self._plan = [divmod(i, cols) for i in range(n)]
+
+    def _relayout_tiles(self):
+        for idx, tile in enumerate(self.preview_tiles.values()):
+            r, c = self._plan[idx] if idx < len(self._plan) else divmod(idx, self._layout_cols)
+            tile.grid(row=r, column=c, padx=6, pady=6, sticky="nsew")
+
     def _open_big_preview(self, cam_id: int, url: str):
         if cam_id in self.big_previews and self.big_previews[cam_id].winfo_exists():
             try: self.big_previews[cam_id].lift(); return
             except Exception: pass
-        win = BigPreview(self, f"معاينة مكبرة — كاميرا #{cam_id}", url)
+        win = BigPreview(self, f"معاينة مكبرة — كاميرا #{cam_id}", url, broker=self.broker)
         self.big_previews[cam_id] = win
 
     def _on_tile_close(self, cam_id: int):
         tile = self.preview_tiles.pop(cam_id, None)
         if tile is not None:
-            try: tile.destroy()
-            except Exception: pass
+            # الإخفاء فوري، والهدم الأثقل يُؤجَّل لوقت الخمول كي لا يتوقف رسم البلاطات الأخرى
+            tile.grid_forget()
+            self._relayout_tiles()
+            self.after_idle(self._destroy_tile, tile)
+
+    def _destroy_tile(self, tile: PreviewTile):
+        tile.stop()
+        try: tile.destroy()
+        except Exception: pass
 
     def on_stop_selected(self):
-        ids = [int(i) for i in self.tree.selection()]
+        ids = {int(i) for i in self.tree.selection()}
         stop_all = not ids
         for k, tile in list(self.preview_tiles.items()):
             if stop_all or (k in ids):
@@ -737,19 +1518,47 @@ class Dashboard(tk.Tk):
         cam_id = int(sel[0]); r = self.rows[cam_id]
         if r["status"] != "SUCCESS" or not r["url"]:
             messagebox.showwarning("تنبيه", "هذه الكاميرا ليست في حالة ناجحة."); return
+        # مصافحة RTSP تبدأ الآن وتتداخل مع وقت اختيار الملف (إلا إذا وُجد مصدر معاينة مشترك)
+        pre = None if self.broker.has_native_feed(r["url"]) else self._snapshot_pool.submit(open_stream, r["url"])
+        asked_at = time.monotonic()
         path = filedialog.asksaveasfilename(defaultextension=".jpg",
                                             filetypes=[("JPEG","*.jpg"),("PNG","*.png"),("All Files","*.*")],
                                             title=f"حفظ لقطة - كاميرا #{cam_id}")
-        if not path: return
+        if not path:
+            if pre is not None: pre.add_done_callback(_release_capture)
+            return
+        if pre is not None and time.monotonic() - asked_at > SNAPSHOT_PREOPEN_MAX_AGE:
+            # بقي الحوار مفتوحاً طويلاً: الاتصال المسبق خامل ومتأخر، فالأرخص فتح جديد
+            pre.add_done_callback(_release_capture)
+            pre = None
         def worker():
-            cap = cv2.VideoCapture(r["url"], cv2.CAP_FFMPEG)
-            ok, frame = cap.read(); cap.release()
+            # من مصدر المعاينة المشترك إن كان مفتوحاً بالحجم الأصلي، وإلا الاتصال المفتوح مسبقاً
+            frame = self.broker.snapshot(r["url"])
+            ok = frame is not None
+            if ok and pre is not None:
+                pre.add_done_callback(_release_capture)
+            if not ok:
+                cap = None
+                if pre is not None:
+                    try: cap = pre.result()
+                    except Exception: cap = None
+                if cap is None:
+                    cap = open_stream(r["url"])
+                # تفريغ الإطارات المخزّنة حتى إطار حي، ثم retrieve مرة واحدة فقط
+                if grab_latest(cap):
+                    ok, frame = cap.retrieve()
+                cap.release()
+            if ok and frame.ndim == 3 and frame.shape[2] == 4:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+            # الترميز والكتابة هنا في خيط العامل لا في خيط Tk
+            saved = False
+            if ok:
+                try:
+                    saved = save_snapshot(path, frame)
+                except Exception:
+                    saved = False
             def done():
-                if ok:
-                    import os
-                    ext = os.path.splitext(path)[1].lower()
-                    if ext == ".png": cv2.imwrite(path, frame, [cv2.IMWRITE_PNG_COMPRESSION, 3])
-                    else: cv2.imwrite(path, frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+                if saved:
                     self._set_status(f"تم حفظ لقطة: {path}", "good")
                 else:
                     self._set_status("تعذر التقاط لقطة.", "bad")